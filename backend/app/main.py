@@ -1,18 +1,21 @@
 # main.py - IMPROVED VERSION
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel, Field
-import os, io, json, re, logging, tempfile
+import os, io, json, re, logging, tempfile, hashlib, sqlite3, time, threading, functools
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, closing, contextmanager
 
-import pdfplumber
+import anyio
+import pypdfium2 as pdfium
 import pytesseract
 from pdf2image import convert_from_path
-from PIL import Image
+from PIL import Image, ImageFilter, ImageOps
 import httpx
-from groq import Groq
+from groq import Groq, NOT_GIVEN
 
 # --- Logging ---
 logging.basicConfig(
@@ -22,12 +25,39 @@ logging.basicConfig(
 logger = logging.getLogger("extractor")
 
 # --- FastAPI ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Pool and limiter are recreated on first use, so a later startup gets fresh ones
+    global _ocr_pool, _pdf_limiter
+    with _worker_lock:
+        pool, _ocr_pool, _pdf_limiter = _ocr_pool, None, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
 app = FastAPI(
     title="PDF Allergen & Nutrition Extractor",
     description="Extract allergen and nutritional information from PDFs using Groq AI",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
+# Registered before CORS so CORS stays the outer layer and 413s still carry its headers
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    """Reject uploads whose declared Content-Length is over the limit before the body is read"""
+    content_length = request.headers.get("content-length", "")
+    if (
+        request.method == "POST"
+        and content_length.isdigit()
+        and int(content_length) > MAX_PDF_SIZE_MB * 1024 * 1024 + MULTIPART_OVERHEAD_BYTES
+    ):
+        return JSONResponse(
+            status_code=413,
+            content={"detail": f"File too large. Maximum size is {MAX_PDF_SIZE_MB}MB."}
+        )
+    return await call_next(request)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -44,170 +74,104 @@ app.add_middleware(
 GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
 GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")  # Upgraded to 70B for better accuracy
 POPPLER_BIN = os.getenv("POPPLER_PATH", r"C:\Program Files\Poppler\Library\bin")
+_POPPLER_PATH = POPPLER_BIN if os.path.exists(POPPLER_BIN) else None  # None -> poppler from PATH
 OCR_LANG = os.getenv("OCR_LANG", "hun+eng")  # Hungarian + English
 MAX_PDF_SIZE_MB = int(os.getenv("MAX_PDF_SIZE_MB", "10"))
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MB per read when streaming uploads to disk
+MULTIPART_OVERHEAD_BYTES = 64 * 1024  # Slack for multipart boundaries/headers in Content-Length
+PDF_MAGIC = b"%PDF-"
+PDF_HEADER_WINDOW = 1024  # PDF readers accept the header anywhere in the first 1 KB
 OCR_DPI = int(os.getenv("OCR_DPI", "300"))  # Increased for better quality
+OCR_MAX_DIM = int(os.getenv("OCR_MAX_DIM", "3000"))  # Longest page side (px) fed to Tesseract
 MAX_OCR_PAGES = int(os.getenv("MAX_OCR_PAGES", "10"))
+BORN_DIGITAL_MIN_CHARS = 50  # First-page chars needed to treat a PDF as having a text layer
+DIRECT_TEXT_LIMIT = 20000  # Stop direct extraction once past the Groq truncation ceiling
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 1)))  # Parallel Tesseract processes
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(max(2, (os.cpu_count() or 1) // 2))))  # Concurrent PDFs in extraction
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.db")  # Empty string disables the cache
+LLM_CACHE_TTL_DAYS = int(os.getenv("LLM_CACHE_TTL_DAYS", "7"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.85"))  # Word-bigram Jaccard; 0 disables
+LLM_MAX_CHARS = 15000  # Groq context limit consideration
+TRUNCATION_MARKER = "\n\n... [TRUNCATED] ...\n\n"
+# Headings that introduce the sections we extract; windows mostly follow the heading
+SECTION_PATTERN = re.compile(r'energia|energy|tápérték|nutrition|összetev|ingredient|allerg', re.IGNORECASE)
+SECTION_BEFORE_CHARS = 250
+SECTION_AFTER_CHARS = 1750
+SECTION_MAX_CHARS = 4000  # Overlapping windows merge up to this length, then a new window starts
+HEAD_CHARS = 2000  # Product name and brand usually sit at the top
 
 # Validate API key
 if not GROQ_API_KEY or GROQ_API_KEY == "your_groq_api_key":
     logger.warning("⚠️  GROQ_API_KEY not configured! Set it in environment variables.")
 
+# One Groq client per process on a persistent keep-alive pool, so TCP+TLS setup is paid once
+GROQ_TIMEOUT = httpx.Timeout(connect=10.0, read=60.0, write=30.0, pool=10.0)
+GROQ_HTTP_CLIENT = httpx.Client(
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+    timeout=GROQ_TIMEOUT,
+)
+GROQ_CLIENT = (
+    Groq(api_key=GROQ_API_KEY, http_client=GROQ_HTTP_CLIENT)
+    if GROQ_API_KEY and GROQ_API_KEY != "your_groq_api_key"
+    else None
+)
+
+# Shared pool for OCR (each worker waits on its own Tesseract subprocess) and a limiter that
+# keeps blocking PDF work off anyio's shared 40-thread pool; both are created lazily
+_worker_lock = threading.Lock()
+_ocr_pool: Optional[ThreadPoolExecutor] = None
+_pdf_limiter: Optional[anyio.CapacityLimiter] = None
+
+def _get_ocr_pool() -> ThreadPoolExecutor:
+    global _ocr_pool
+    with _worker_lock:
+        if _ocr_pool is None:
+            _ocr_pool = ThreadPoolExecutor(max_workers=max(1, OCR_WORKERS), thread_name_prefix="ocr")
+        return _ocr_pool
+
+def _get_pdf_limiter() -> anyio.CapacityLimiter:
+    global _pdf_limiter
+    with _worker_lock:
+        if _pdf_limiter is None:
+            _pdf_limiter = anyio.CapacityLimiter(PDF_WORKERS)
+        return _pdf_limiter
+
 # --- Enhanced System Prompt ---
-SYSTEM_PROMPT = """You are a highly specialized AI system for extracting structured information from food product labels and nutritional specifications.
-
-Your task is to analyze the extracted text of a food product document (e.g., PDF, OCR result) and return a complete structured JSON response following the exact schema below.
-
-==========================
-EXTRACTION INSTRUCTIONS
-==========================
-
-1. **Purpose**  
-   Identify and extract all key information related to product identity, ingredients, allergens, and nutrition facts.  
-   The goal is to produce a clean, structured JSON for database storage or API integration.
-
-2. **Text Input**  
-   You will receive plain text extracted from food product PDFs. The text may contain both Hungarian and English words (e.g., "összetevők", "ingredients", "energia", "energy").
-
-3. **Detection Strategy**
-   - Focus on the factual information — do not infer or assume values.
-   - If multiple values or tables appear, choose the **most complete per 100g / 100ml** section.
-   - Recognize both Hungarian and English keywords (e.g., “energia”, “energy”, “zsír”, “fat”, “fehérje”, “protein”).
-   - Convert commas to decimal points (4,5 → 4.5).
-   - Remove units (“g”, “kJ”, “kcal”) from numeric values.
-   - If salt value is given, compute sodium ≈ salt × 0.4 (in grams).
-
-4. **Allergen Identification**
-   - Analyze ingredient lists and allergen statements.
-   - Detect phrases such as “Allergens:”, “Contains:”, “May contain:”, “Allergén információ:”, “Nyomokban tartalmazhat”.
-   - Distinguish between:
-     - `"contains"` → explicitly stated or clearly present in ingredients.
-     - `"may_contain"` → indicated as possible traces.
-   - Check both English and Hungarian synonyms.
-   - If unsure or unclear → mark `present=false` and `contains_or_may_contain=null`.
-
-5. **Confidence**
-   - `"high"` → clear, explicit data extracted.
-   - `"medium"` → minor uncertainty (e.g., incomplete table).
-   - `"low"` → text ambiguous or noisy.
-
-==========================
-OUTPUT REQUIREMENTS
-==========================
-
-ALLERGEN IDENTIFICATION:
-- The PDF may express allergen presence using symbols or keywords:
-  - "+" or "tartalmaz" → means "contains"
-  - "nyomokban" or "may contain" → means "may_contain"
-  - "-" or "mentes" → means "absent" (present = false)
-- Table headings such as "Allergens information / Allergén információk" indicate the allergen section.
-- Each allergen can appear in bilingual form (e.g. "milk protein / tejfehérje", "soy protein / szója fehérje").
-- Always detect the allergen **even if it only appears in Hungarian**.
-- When multiple allergens are listed, map them to the following standard 10 classes:
-  1. Gluten (wheat, rye, barley, oats, búza, rozs, árpa, zab)
-  2. Eggs (tojás)
-  3. Crustaceans (shrimp, crab, lobster, rákfélék)
-  4. Fish (hal)
-  5. Peanuts (földimogyoró)
-  6. Soybeans (soy, szója)
-  7. Milk (dairy, lactose, tej, tejfehérje)
-  8. Nuts (tree nuts: dió, mandula, mogyoró, kesudió, pekándió, pisztácia)
-  9. Celery (zeller)
-  10. Mustard (mustár)
-- If allergen has a “+” mark, or the text says “contains”, mark:
-  `"present": true, "contains_or_may_contain": "contains"`
-- If allergen is marked “nyomokban”, “may contain”, or has a “+” with a note about traces, mark:
-  `"present": true, "contains_or_may_contain": "may_contain"`
-- If allergen is marked “-” or “mentes”, mark:
-  `"present": false, "contains_or_may_contain": null`
-- If ambiguous or missing, mark `"present": false`.
-- When possible, fill `"source"` with the Hungarian ingredient name (e.g. "búzaliszt", "tejfehérje", "szója fehérje").
-
-- When an allergen is mentioned together with the phrase “nyomokban”, “may contain”, or “tartalmazhat”,
-  always set:
-  "present": true,
-  "contains_or_may_contain": "may_contain".
-
-- When the text says “tartalmaz”, “contains”, or the allergen has a “+” mark without mention of traces,
-  set:
-  "present": true,
-  "contains_or_may_contain": "contains".
-
-- If an allergen appears in a list with both “tartalmaz” and “nyomokban” mentions, prefer “may_contain”.
-  (Assume trace contamination if any uncertainty exists.)
-
-Return ONLY valid JSON in the exact format below.
-Do NOT include any commentary, explanations, or text outside the JSON.
-All numeric values must be plain numbers (no units, no strings).
-Use `null` for any missing or uncertain values.
+PROMPT_VERSION = "v3"  # Bump on every SYSTEM_PROMPT change to invalidate cached responses
+
+SYSTEM_PROMPT = """You extract structured information from food product labels and nutritional specifications.
+
+The input is plain text extracted from a food product PDF (direct text or OCR). It may mix Hungarian and English (e.g. "összetevők"/"ingredients", "energia"/"energy", "zsír"/"fat", "fehérje"/"protein").
+
+NUTRITION
+- Extract only facts present in the text; never infer or guess.
+- If several tables appear, use the most complete per 100g / 100ml section.
+- Numbers must be plain floats: convert decimal commas (4,5 -> 4.5) and drop units (g, kJ, kcal).
+- If salt is given, compute sodium_g = salt_g * 0.4.
+
+ALLERGENS
+Report exactly these 10 allergens, in this order:
+["Gluten", "Eggs", "Crustaceans", "Fish", "Peanuts", "Soybeans", "Milk", "Nuts", "Celery", "Mustard"]
+Synonyms: Gluten = wheat, rye, barley, oats, búza, rozs, árpa, zab; Eggs = tojás; Crustaceans = shrimp, crab, lobster, rákfélék; Fish = hal; Peanuts = földimogyoró; Soybeans = soy, szója; Milk = dairy, lactose, tej, tejfehérje; Nuts = tree nuts, dió, mandula, mogyoró, kesudió, pekándió, pisztácia; Celery = zeller; Mustard = mustár.
+- Look in ingredient lists, allergen statements and allergen tables ("Allergens:", "Contains:", "May contain:", "Allergén információ", "Nyomokban tartalmazhat"). Detect an allergen even if it appears only in Hungarian or in bilingual form (e.g. "milk protein / tejfehérje").
+- "contains": "+" mark, "tartalmaz", "contains", or clearly present in ingredients -> present=true, contains_or_may_contain="contains".
+- "may_contain": "nyomokban", "may contain", "tartalmazhat", or a "+" with a note about traces -> present=true, contains_or_may_contain="may_contain". If both "contains" and trace wording apply, prefer "may_contain".
+- "-", "mentes", absent, ambiguous or missing -> present=false, contains_or_may_contain=null.
+- Fill "source" with the Hungarian ingredient name when possible (e.g. "búzaliszt", "tejfehérje", "szója fehérje").
+
+CONFIDENCE
+meta.confidence: "high" = clear, explicit data; "medium" = minor uncertainty (e.g. incomplete table); "low" = ambiguous or noisy text.
+
+OUTPUT
+Return ONLY valid JSON, no commentary. Use null for missing or uncertain values. Preserve ingredient order and special characters; prefer Hungarian when languages are mixed.
+Each entry of "allergens" is {"name": one of the 10 names, "present": true/false, "source": "string or null", "contains_or_may_contain": "contains" or "may_contain" or null}.
 
 {
   "product_name": "string or null",
   "brand": "string or null",
   "net_quantity": {"amount": number, "unit": "string"} or null,
   "ingredients_text": "string or null",
-  "allergens": [
-    {
-      "name": "Gluten",
-      "present": true/false,
-      "source": "string or null",
-      "contains_or_may_contain": "contains" or "may_contain" or null
-    },
-    {
-      "name": "Eggs",
-      "present": true/false,
-      "source": "string or null",
-      "contains_or_may_contain": "contains" or "may_contain" or null
-    },
-    {
-      "name": "Crustaceans",
-      "present": true/false,
-      "source": "string or null",
-      "contains_or_may_contain": "contains" or "may_contain" or null
-    },
-    {
-      "name": "Fish",
-      "present": true/false,
-      "source": "string or null",
-      "contains_or_may_contain": "contains" or "may_contain" or null
-    },
-    {
-      "name": "Peanuts",
-      "present": true/false,
-      "source": "string or null",
-      "contains_or_may_contain": "contains" or "may_contain" or null
-    },
-    {
-      "name": "Soybeans",
-      "present": true/false,
-      "source": "string or null",
-      "contains_or_may_contain": "contains" or "may_contain" or null
-    },
-    {
-      "name": "Milk",
-      "present": true/false,
-      "source": "string or null",
-      "contains_or_may_contain": "contains" or "may_contain" or null
-    },
-    {
-      "name": "Nuts",
-      "present": true/false,
-      "source": "string or null",
-      "contains_or_may_contain": "contains" or "may_contain" or null
-    },
-    {
-      "name": "Celery",
-      "present": true/false,
-      "source": "string or null",
-      "contains_or_may_contain": "contains" or "may_contain" or null
-    },
-    {
-      "name": "Mustard",
-      "present": true/false,
-      "source": "string or null",
-      "contains_or_may_contain": "contains" or "may_contain" or null
-    }
-  ],
+  "allergens": [{"name": "Gluten", "present": true, "source": "búzaliszt", "contains_or_may_contain": "contains"}, ...],
   "nutrition": {
     "basis": "per_100g" or "per_serving" or null,
     "energy_kj": number or null,
@@ -226,18 +190,10 @@ Use `null` for any missing or uncertain values.
   "notes": "string or null",
   "meta": {"confidence": "high" or "medium" or "low"}
 }
-
-==========================
-ADDITIONAL GUIDELINES
-==========================
-- Do not hallucinate data that is not explicitly found.
-- Prefer null over guessing.
-- Use floating-point numbers (not strings) for nutrition values.
-- Preserve ingredient order and special characters in the ingredient list.
-- When multiple languages are mixed, prioritize Hungarian if available.
-- Output **MUST** be strictly valid JSON.
 """
 
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
 # --- Pydantic Models ---
 class Quantity(BaseModel):
     amount: Optional[float] = None
@@ -275,20 +231,39 @@ class ExtractResponse(BaseModel):
     meta: Dict[str, Any] = Field(default_factory=dict)
 
 # --- PDF Text Extraction ---
+# PDFium is not thread-safe, so every call into it is serialized. It is only used for
+# text (fast); page rendering goes through poppler processes, which run in parallel.
+_PDFIUM_LOCK = threading.Lock()
+
+@contextmanager
+def _open_pdf(pdf_path: str):
+    """Open a PDF with PDFium while holding the PDFium lock"""
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            yield pdf
+        finally:
+            pdf.close()
+
 def extract_text_from_pdf(pdf_path: str) -> tuple[str, str]:
     """
-    Extract text from PDF, trying direct extraction first, then OCR.
+    Extract text from PDF, routing born-digital files to direct extraction
+    and scanned files straight to OCR.
     Returns: (text, mode) where mode is 'text' or 'ocr'
     """
-    # Try direct text extraction first (fast)
-    text = _extract_text_direct(pdf_path)
-    
-    if text and len(text.strip()) > 100:  # Reasonable amount of text found
-        logger.info(f"✓ Extracted {len(text)} chars using direct method")
-        return text, "text"
+    if _is_born_digital(pdf_path):
+        # Text layer present, direct extraction (fast)
+        text = _extract_text_direct(pdf_path)
+        
+        if text and len(text.strip()) > 100:  # Reasonable amount of text found
+            logger.info(f"✓ Extracted {len(text)} chars using direct method")
+            return text, "text"
+        
+        # Safety net: fall back to OCR when the text layer turns out to be thin
+        logger.info("→ Direct extraction insufficient, using OCR...")
+    else:
+        logger.info("→ No text layer detected, using OCR...")
     
-    # Fall back to OCR (slower but handles scanned PDFs)
-    logger.info("→ Direct extraction insufficient, using OCR...")
     text = _extract_text_ocr(pdf_path)
     
     if text:
@@ -297,34 +272,65 @@ def extract_text_from_pdf(pdf_path: str) -> tuple[str, str]:
     
     return "", "empty"
 
+def _is_born_digital(pdf_path: str) -> bool:
+    """Check whether the first page carries a real text layer (not a scan)"""
+    try:
+        with _open_pdf(pdf_path) as pdf:
+            if len(pdf) == 0:
+                return False
+            page = pdf[0]
+            textpage = page.get_textpage()
+            try:
+                return textpage.count_chars() > BORN_DIGITAL_MIN_CHARS
+            finally:
+                textpage.close()
+                page.close()
+    except Exception as e:
+        logger.error(f"Born-digital detection error: {e}")
+        return True  # Let direct extraction and its OCR fallback decide
+
 def _extract_text_direct(pdf_path: str) -> str:
-    """Direct text extraction using pdfplumber"""
+    """Direct text extraction using PDFium"""
     chunks = []
+    total_len = 0
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            for page_num, page in enumerate(pdf.pages, 1):
-                text = page.extract_text()
+        with _open_pdf(pdf_path) as pdf:
+            for page_num in range(1, len(pdf) + 1):
+                page = pdf[page_num - 1]
+                textpage = page.get_textpage()
+                text = textpage.get_text_range().replace("\r\n", "\n").strip()
+                textpage.close()
+                page.close()
                 if text:
                     chunks.append(f"--- Page {page_num} ---\n{text}\n")
+                    total_len += len(text)
+                if total_len > DIRECT_TEXT_LIMIT:
+                    logger.info(f"  Direct extraction stopped after page {page_num} ({total_len} chars)")
+                    break
         return "".join(chunks).strip()
     except Exception as e:
         logger.error(f"Direct extraction error: {e}")
         return ""
 
 def _extract_text_ocr(pdf_path: str) -> str:
-    """OCR extraction using Tesseract"""
+    """OCR extraction using Tesseract, page ranges are rendered and recognized in parallel"""
     try:
-        # Convert PDF to images
-        images = convert_from_path(
-            pdf_path,
-            dpi=OCR_DPI,
-            poppler_path=POPPLER_BIN if os.path.exists(POPPLER_BIN) else None
-        )
+        with _open_pdf(pdf_path) as pdf:
+            page_count = min(len(pdf), MAX_OCR_PAGES)
+        if page_count < 1:
+            return ""
+        
+        # One contiguous page range per worker: each renders its own pages and runs a single
+        # Tesseract process over them, so rasterizing one range overlaps OCR of another
+        batch_size = -(-page_count // max(1, OCR_WORKERS))
+        first_pages = list(range(1, page_count + 1, batch_size))
+        last_pages = [min(first + batch_size - 1, page_count) for first in first_pages]
+        logger.info(f"  OCR processing {page_count} page(s) in {len(first_pages)} batch(es)")
+        batches = _get_ocr_pool().map(_ocr_page_range, [pdf_path] * len(first_pages), first_pages, last_pages)
+        page_texts = [text for batch in batches for text in batch]
         
         texts = []
-        for page_num, image in enumerate(images[:MAX_OCR_PAGES], 1):
-            logger.info(f"  OCR processing page {page_num}/{len(images[:MAX_OCR_PAGES])}")
-            text = pytesseract.image_to_string(image, lang=OCR_LANG)
+        for page_num, text in enumerate(page_texts, 1):
             if text:
                 texts.append(f"--- Page {page_num} ---\n{text}\n")
         
@@ -334,35 +340,270 @@ def _extract_text_ocr(pdf_path: str) -> str:
         logger.error(f"OCR extraction error: {e}")
         return ""
 
+def _ocr_page_range(pdf_path: str, first_page: int, last_page: int) -> List[str]:
+    """Rasterize pages first_page..last_page (1-based, inclusive) with poppler and OCR them"""
+    images = convert_from_path(
+        pdf_path,
+        dpi=OCR_DPI,
+        grayscale=True,
+        first_page=first_page,
+        last_page=last_page,
+        poppler_path=_POPPLER_PATH
+    )
+    return _ocr_batch(images)
+
+def _ocr_batch(images: List[Image.Image]) -> List[str]:
+    """Run a single Tesseract invocation over several pages via an image list file"""
+    with tempfile.TemporaryDirectory(prefix="ocr_") as tmp_dir:
+        paths = []
+        for index, image in enumerate(images):
+            path = os.path.join(tmp_dir, f"page_{index:03d}.png")
+            _prepare_for_ocr(image).save(path)
+            paths.append(path)
+        
+        list_path = os.path.join(tmp_dir, "tess_imagelist.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(paths) + "\n")
+        
+        output = pytesseract.image_to_string(list_path, lang=OCR_LANG)
+    
+    # Tesseract separates pages with a form feed
+    pages = [page.strip() for page in output.split("\f")]
+    return (pages + [""] * len(images))[:len(images)]
+
+def _prepare_for_ocr(image: Image.Image) -> Image.Image:
+    """Grayscale, downsample oversized pages and sharpen text edges"""
+    image = image.convert("L")
+    if max(image.size) > OCR_MAX_DIM:
+        image.thumbnail((OCR_MAX_DIM, OCR_MAX_DIM), Image.LANCZOS)
+    image = ImageOps.autocontrast(image)
+    return image.filter(ImageFilter.UnsharpMask(radius=2, percent=100, threshold=3))
+
+# --- LLM Response Cache ---
+_llm_cache_local = threading.local()
+
+def _llm_cache_init() -> None:
+    """Create the cache schema once per process"""
+    with closing(sqlite3.connect(LLM_CACHE_PATH, timeout=5.0)) as conn, conn:
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS llm_cache (
+                input_hash TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (input_hash, prompt_version, model)
+            )"""
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_created_at ON llm_cache (created_at)")
+        # Rows keyed on numbers alone could serve a label with different allergen wording
+        conn.execute("DROP TABLE IF EXISTS llm_semantic_cache")
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS llm_near_duplicate_cache (
+                exact_hash TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                model TEXT NOT NULL,
+                sketch TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )"""
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_llm_near_duplicate_cache_key"
+            " ON llm_near_duplicate_cache (exact_hash, prompt_version, model)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_llm_near_duplicate_cache_created_at"
+            " ON llm_near_duplicate_cache (created_at)"
+        )
+
+def _llm_cache_connection() -> sqlite3.Connection:
+    """Return this thread's cache connection, opening it on first use"""
+    conn = getattr(_llm_cache_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(LLM_CACHE_PATH, timeout=5.0)
+        _llm_cache_local.conn = conn
+    return conn
+
+def _llm_cache_get(input_hash: str) -> Optional[Dict[str, Any]]:
+    """Return a cached Groq response for this input, if present and not expired"""
+    if not LLM_CACHE_PATH:
+        return None
+    cutoff = time.time() - LLM_CACHE_TTL_DAYS * 86400
+    try:
+        row = _llm_cache_connection().execute(
+            "SELECT response FROM llm_cache"
+            " WHERE input_hash = ? AND prompt_version = ? AND model = ? AND created_at >= ?",
+            (input_hash, PROMPT_VERSION, GROQ_MODEL, cutoff),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    except Exception as e:
+        logger.warning(f"LLM cache read failed: {e}")
+        return None
+
+def _llm_cache_put(input_hash: str, data: Dict[str, Any]) -> None:
+    """Store a Groq response and drop expired entries"""
+    if not LLM_CACHE_PATH:
+        return
+    now = time.time()
+    try:
+        conn = _llm_cache_connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache"
+                " (input_hash, prompt_version, model, response, created_at) VALUES (?, ?, ?, ?, ?)",
+                (input_hash, PROMPT_VERSION, GROQ_MODEL, json.dumps(data), now),
+            )
+            conn.execute(
+                "DELETE FROM llm_cache WHERE created_at < ?",
+                (now - LLM_CACHE_TTL_DAYS * 86400,),
+            )
+    except Exception as e:
+        logger.warning(f"LLM cache write failed: {e}")
+
+if LLM_CACHE_PATH:
+    try:
+        _llm_cache_init()
+    except Exception as e:
+        logger.warning(f"LLM cache setup failed: {e}")
+
+# --- Near-duplicate (semantic) cache ---
+SKETCH_SIZE = 128  # Bottom-k MinHash size
+SEMANTIC_CACHE_SCAN_LIMIT = 50  # Most recent candidates compared per lookup
+NUM_PATTERN = re.compile(r'([-+]?\d+(?:[.,]\d+)?)')
+WORD_PATTERN = re.compile(r'[^\W\d_]+')
+# Allergen names and synonyms from the prompt, trace/contains/free wording and
+# standalone +/- marks; any word starting with a stem counts ("mogyorót", "tejmentes")
+ALLERGEN_TOKEN_PATTERN = re.compile(
+    r'(?<![^\W\d_])(?:glut|wheat|rye|barley|oat|búza|rozs|árpa|zab'
+    r'|egg|tojás|crustacean|shrimp|crab|lobster|rák|fish|hal'
+    r'|peanut|földimogyoró|soy|szój|milk|dairy|lact|lakt|tej'
+    r'|nut|dió|mandul|mogyoró|kesudió|pekándió|pisztác|celer|zeller|mustár|mustard'
+    r'|nyomokban|trace|tartalmaz|contain|mentes|free)[^\W\d_]*'
+    r'|(?<![\w+-])[+-](?![\w+-])',
+    re.IGNORECASE
+)
+
+def _text_fingerprint(text: str) -> tuple[str, List[int]]:
+    """
+    Fingerprint text for near-duplicate lookups.
+    Numbers and allergen wording must match exactly (hashed in order) so a
+    re-scan with OCR noise in the wording can hit, but a label with different
+    nutrition values or a changed "may contain" line cannot.
+    Wording is summarized as a bottom-k MinHash sketch of word bigrams: one
+    misread word changes two bigrams, so a 150-word label with 3 OCR typos
+    still scores ~0.94 while unrelated wording stays far below 0.85.
+    """
+    numbers = " ".join(m.replace(',', '.') for m in NUM_PATTERN.findall(text))
+    allergens = " ".join(m.lower() for m in ALLERGEN_TOKEN_PATTERN.findall(text))
+    exact_hash = hashlib.sha256(f"{numbers}\n{allergens}".encode("utf-8")).hexdigest()
+    
+    words = WORD_PATTERN.findall(text.lower())
+    shingles = {" ".join(words[i:i + 2]) for i in range(max(1, len(words) - 1))}
+    hashes = {
+        int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for shingle in shingles
+    }
+    return exact_hash, sorted(hashes)[:SKETCH_SIZE]
+
+def _sketch_similarity(a: List[int], b: List[int]) -> float:
+    """Estimate Jaccard similarity of two shingle sets from their bottom-k sketches"""
+    set_a, set_b = set(a), set(b)
+    union = sorted(set_a | set_b)[:SKETCH_SIZE]
+    if not union:
+        return 0.0
+    return sum(1 for h in union if h in set_a and h in set_b) / len(union)
+
+def _semantic_cache_get(exact_hash: str, sketch: List[int]) -> Optional[Dict[str, Any]]:
+    """Return the cached response of the most similar earlier text above the threshold"""
+    if not LLM_CACHE_PATH or SEMANTIC_CACHE_THRESHOLD <= 0:
+        return None
+    cutoff = time.time() - LLM_CACHE_TTL_DAYS * 86400
+    try:
+        rows = _llm_cache_connection().execute(
+            "SELECT sketch, response FROM llm_near_duplicate_cache"
+            " WHERE exact_hash = ? AND prompt_version = ? AND model = ? AND created_at >= ?"
+            " ORDER BY created_at DESC LIMIT ?",
+            (exact_hash, PROMPT_VERSION, GROQ_MODEL, cutoff, SEMANTIC_CACHE_SCAN_LIMIT),
+        ).fetchall()
+        best_score, best_response = 0.0, None
+        for row_sketch, response in rows:
+            score = _sketch_similarity(sketch, json.loads(row_sketch))
+            if score > best_score:
+                best_score, best_response = score, response
+        if best_response is not None and best_score >= SEMANTIC_CACHE_THRESHOLD:
+            logger.info(f"✓ Semantic cache hit (similarity {best_score:.2f})")
+            return json.loads(best_response)
+        return None
+    except Exception as e:
+        logger.warning(f"Semantic cache read failed: {e}")
+        return None
+
+def _semantic_cache_put(exact_hash: str, sketch: List[int], data: Dict[str, Any]) -> None:
+    """Store a Groq response under the text fingerprint and drop expired entries"""
+    if not LLM_CACHE_PATH or SEMANTIC_CACHE_THRESHOLD <= 0:
+        return
+    now = time.time()
+    try:
+        conn = _llm_cache_connection()
+        with conn:
+            conn.execute(
+                "INSERT INTO llm_near_duplicate_cache"
+                " (exact_hash, prompt_version, model, sketch, response, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (exact_hash, PROMPT_VERSION, GROQ_MODEL, json.dumps(sketch), json.dumps(data), now),
+            )
+            conn.execute(
+                "DELETE FROM llm_near_duplicate_cache WHERE created_at < ?",
+                (now - LLM_CACHE_TTL_DAYS * 86400,),
+            )
+    except Exception as e:
+        logger.warning(f"Semantic cache write failed: {e}")
+
 # --- Groq AI Processing ---
 def extract_with_groq(raw_text: str, timeout_seconds: int = 60) -> Dict[str, Any]:
     """
     Send extracted text to Groq for AI analysis
+    Responses are cached by SHA-256 of the text, prompt version and model,
+    with a near-duplicate fallback for re-scans of the same label.
     """
-    if not GROQ_API_KEY or GROQ_API_KEY == "your_groq_api_key":
+    input_hash = hashlib.sha256(raw_text.encode("utf-8")).hexdigest()
+    cached = _llm_cache_get(input_hash)
+    if cached is not None:
+        logger.info(f"✓ LLM cache hit ({input_hash[:12]})")
+        return cached
+    
+    exact_hash, sketch = _text_fingerprint(raw_text)
+    cached = _semantic_cache_get(exact_hash, sketch)
+    if cached is not None:
+        return cached
+    
+    if GROQ_CLIENT is None:
         raise RuntimeError("GROQ_API_KEY is not configured. Please set it in environment variables.")
     
-    # Truncate text if too long (keep beginning and end)
-    max_chars = 15000  # Groq context limit consideration
-    if len(raw_text) > max_chars:
-        half = max_chars // 2
-        raw_text = raw_text[:half] + "\n\n... [TRUNCATED] ...\n\n" + raw_text[-half:]
-        logger.warning(f"Text truncated to {max_chars} chars")
+    # Truncate text if too long (keep the head and the label sections)
+    if len(raw_text) > LLM_MAX_CHARS:
+        raw_text = _truncate_for_llm(raw_text)
+        logger.warning(f"Text truncated to {len(raw_text)} chars")
     
     try:
-        client = Groq(api_key=GROQ_API_KEY)
-        
         logger.info(f"→ Sending {len(raw_text)} chars to Groq ({GROQ_MODEL})...")
         
-        response = client.chat.completions.create(
+        response = GROQ_CLIENT.chat.completions.create(
             model=GROQ_MODEL,
             temperature=0.1,  # Low temperature for consistent extraction
             response_format={"type": "json_object"},  # Force JSON output
             messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
+                _SYSTEM_MSG,
                 {"role": "user", "content": f"Extract all information from this text:\n\n{raw_text}"}
             ],
-            timeout=httpx.Timeout(connect=10.0, read=timeout_seconds, write=30.0, pool=10.0),
+            # The client timeout already covers the default read limit
+            timeout=(
+                NOT_GIVEN if timeout_seconds == GROQ_TIMEOUT.read
+                else httpx.Timeout(
+                    connect=GROQ_TIMEOUT.connect, read=timeout_seconds,
+                    write=GROQ_TIMEOUT.write, pool=GROQ_TIMEOUT.pool,
+                )
+            ),
         )
         
         content = response.choices[0].message.content or "{}"
@@ -370,6 +611,9 @@ def extract_with_groq(raw_text: str, timeout_seconds: int = 60) -> Dict[str, Any
         
         # Parse JSON
         data = _extract_json_safely(content)
+        if data:
+            _llm_cache_put(input_hash, data)
+            _semantic_cache_put(exact_hash, sketch, data)
         return data
     
     except httpx.TimeoutException:
@@ -379,6 +623,49 @@ def extract_with_groq(raw_text: str, timeout_seconds: int = 60) -> Dict[str, Any
         logger.error(f"Groq API error: {e}")
         raise HTTPException(status_code=500, detail=f"AI processing failed: {str(e)}")
 
+def _truncate_for_llm(text: str, max_chars: int = LLM_MAX_CHARS) -> str:
+    """
+    Shorten text to at most max_chars (plus separators) keeping a window around
+    every nutrition/ingredient/allergen heading. The last window is kept first so
+    a table at the end of the document always survives, then the others in
+    document order; any budget left over goes to the head and the tail.
+    """
+    windows = []
+    for match in SECTION_PATTERN.finditer(text):
+        start = max(0, match.start() - SECTION_BEFORE_CHARS)
+        end = min(len(text), match.start() + SECTION_AFTER_CHARS)
+        if windows and start <= windows[-1][1]:
+            last_start, last_end = windows[-1]
+            if end - last_start <= SECTION_MAX_CHARS:
+                windows[-1] = (last_start, end)
+            else:
+                windows.append((last_end, end))
+        else:
+            windows.append((start, end))
+    
+    budget = max_chars - HEAD_CHARS
+    keep = []
+    for start, end in windows[-1:] + windows[:-1]:
+        take = min(end - start, budget)
+        if take <= 0:
+            break
+        keep.append((start, start + take))
+        budget -= take
+    keep.append((0, HEAD_CHARS + budget // 2))
+    keep.append((len(text) - budget // 2, len(text)))
+    
+    merged = []
+    for start, end in sorted(keep):
+        if end <= start:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return TRUNCATION_MARKER.join(text[start:end] for start, end in merged)
+
+JSON_BLOCK_PATTERN = re.compile(r'```(?:json)?\s*(\{.*?\})\s*```', re.DOTALL)
+
 def _extract_json_safely(text: str) -> Dict[str, Any]:
     """Extract JSON from text that might contain markdown or extra content"""
     # Try 1: Direct parse
@@ -388,7 +675,7 @@ def _extract_json_safely(text: str) -> Dict[str, Any]:
         pass
     
     # Try 2: Extract from code block
-    match = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', text, re.DOTALL)
+    match = JSON_BLOCK_PATTERN.search(text)
     if match:
         try:
             return json.loads(match.group(1))
@@ -408,7 +695,14 @@ def _extract_json_safely(text: str) -> Dict[str, Any]:
     return {}
 
 # --- Data Normalization ---
-NUM_PATTERN = re.compile(r'([-+]?\d+(?:[.,]\d+)?)')
+# Unit must not touch other letters ("250ml" -> ml rather than l, the "g" in "weight" is ignored)
+UNIT_PATTERN = re.compile(r'(?<![^\W\d_])(kg|ml|cl|pcs|oz|lb|db|g|l)(?![^\W\d_])', re.IGNORECASE)
+
+NUTRITION_NUMERIC_FIELDS = (
+    "energy_kj", "energy_kcal", "fat_g", "saturated_fat_g",
+    "carbohydrate_g", "sugars_g", "protein_g", "fiber_g",
+    "salt_g", "sodium_g"
+)
 
 def normalize_data(data: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -423,12 +717,7 @@ def normalize_data(data: Dict[str, Any]) -> Dict[str, Any]:
     # Normalize nutrition values
     nutrition = data.get("nutrition")
     if isinstance(nutrition, dict):
-        numeric_fields = [
-            "energy_kj", "energy_kcal", "fat_g", "saturated_fat_g",
-            "carbohydrate_g", "sugars_g", "protein_g", "fiber_g",
-            "salt_g", "sodium_g"
-        ]
-        for field in numeric_fields:
+        for field in NUTRITION_NUMERIC_FIELDS:
             nutrition[field] = _extract_number(nutrition.get(field))
     
     # Normalize net_quantity
@@ -447,14 +736,10 @@ def _extract_number(value) -> Optional[float]:
     if isinstance(value, (int, float)):
         return float(value)
     if isinstance(value, str):
-        # Remove units and extract number
-        match = NUM_PATTERN.search(value)
+        # Remove units and extract number; the pattern guarantees a valid float
+        match = NUM_PATTERN.search(value.replace(',', '.'))
         if match:
-            num_str = match.group(1).replace(',', '.')
-            try:
-                return float(num_str)
-            except:
-                return None
+            return float(match.group(1))
     return None
 
 def _extract_unit(value: str) -> Optional[str]:
@@ -462,15 +747,8 @@ def _extract_unit(value: str) -> Optional[str]:
     if not isinstance(value, str):
         return None
     
-    # Common units
-    units = ['kg', 'g', 'l', 'ml', 'cl', 'oz', 'lb', 'db', 'pcs']
-    value_lower = value.lower()
-    
-    for unit in units:
-        if unit in value_lower:
-            return unit
-    
-    return None
+    match = UNIT_PATTERN.search(value)
+    return match.group(1).lower() if match else None
 
 # --- API Endpoints ---
 @app.get("/")
@@ -508,91 +786,100 @@ async def extract_from_pdf(file: UploadFile = File(...)):
     3. Send to Groq AI for analysis
     4. Return structured JSON
     """
-    # Validate file type
-    if file.content_type != "application/pdf":
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid file type: {file.content_type}. Only PDF files are accepted."
-        )
-    
-    # Read file
-    file_content = await file.read()
-    file_size_mb = len(file_content) / (1024 * 1024)
-    
-    # Check file size
-    if file_size_mb > MAX_PDF_SIZE_MB:
+    # Reject on the declared size before copying anything
+    if file.size is not None and file.size > MAX_PDF_SIZE_MB * 1024 * 1024:
         raise HTTPException(
             status_code=413,
-            detail=f"File too large: {file_size_mb:.1f}MB. Maximum size is {MAX_PDF_SIZE_MB}MB."
+            detail=f"File too large: {file.size / (1024 * 1024):.1f}MB. Maximum size is {MAX_PDF_SIZE_MB}MB."
         )
     
-    logger.info(f"📄 Processing PDF: {file.filename} ({file_size_mb:.2f}MB)")
-    
-    # Save to temporary file
-    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp_file:
-        tmp_file.write(file_content)
-        pdf_path = tmp_file.name
-    
-    try:
-        # Step 1: Extract text from PDF
-        extracted_text, extraction_mode = extract_text_from_pdf(pdf_path)
-        
-        if not extracted_text or len(extracted_text.strip()) < 10:
-            logger.warning("No text could be extracted from PDF")
-            return ExtractResponse(
-                allergens=[],
-                nutrition=None,
-                meta={
-                    "mode": "empty",
-                    "error": "No text found in PDF",
-                    "filename": file.filename
-                }
-            )
-        
-        # Step 2: Send to Groq for AI analysis
-        raw_data = extract_with_groq(extracted_text, timeout_seconds=60)
-        
-        # Step 3: Normalize data
-        normalized_data = normalize_data(raw_data)
-        
-        # Step 4: Validate with Pydantic
+    # The directory (and the PDF inside it) is removed when the block exits
+    with tempfile.TemporaryDirectory(prefix="nutriext_") as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, "upload.pdf")
         try:
-            result = ExtractResponse.model_validate(normalized_data)
-        except Exception as validation_error:
-            logger.error(f"Validation error: {validation_error}")
-            # Return partial data on validation failure
-            result = ExtractResponse(
-                allergens=normalized_data.get("allergens", []),
-                nutrition=normalized_data.get("nutrition"),
-                meta={"validation_error": str(validation_error)}
+            # Stream upload to the temporary file chunk by chunk, enforcing the size limit as we go
+            with open(pdf_path, "wb") as tmp_file:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                
+                # Validate file type by its header, not the client-supplied content type
+                if PDF_MAGIC not in chunk[:PDF_HEADER_WINDOW]:
+                    raise HTTPException(
+                        status_code=415,
+                        detail=f"Invalid file: {file.filename} is not a PDF document. Only PDF files are accepted."
+                    )
+                
+                file_size = 0
+                while chunk:
+                    file_size += len(chunk)
+                    if file_size > MAX_PDF_SIZE_MB * 1024 * 1024:
+                        raise HTTPException(
+                            status_code=413,
+                            detail=f"File too large. Maximum size is {MAX_PDF_SIZE_MB}MB."
+                        )
+                    tmp_file.write(chunk)
+                    chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                tmp_file.flush()
+                file_size_mb = os.fstat(tmp_file.fileno()).st_size / (1024 * 1024)
+            
+            logger.info(f"📄 Processing PDF: {file.filename} ({file_size_mb:.2f}MB)")
+            
+            # Step 1: Extract text from PDF (blocking PDFium/poppler/Tesseract work, bounded thread pool)
+            extracted_text, extraction_mode = await anyio.to_thread.run_sync(
+                extract_text_from_pdf, pdf_path, limiter=_get_pdf_limiter()
             )
+            
+            if not extracted_text or len(extracted_text.strip()) < 10:
+                logger.warning("No text could be extracted from PDF")
+                return ExtractResponse(
+                    allergens=[],
+                    nutrition=None,
+                    meta={
+                        "mode": "empty",
+                        "error": "No text found in PDF",
+                        "filename": file.filename
+                    }
+                )
+            
+            # Step 2: Send to Groq for AI analysis
+            raw_data = await anyio.to_thread.run_sync(
+                functools.partial(extract_with_groq, extracted_text, timeout_seconds=60)
+            )
+            
+            # Step 3: Normalize data
+            normalized_data = normalize_data(raw_data)
+            
+            # Step 4: Validate with Pydantic
+            try:
+                result = ExtractResponse.model_validate(normalized_data)
+            except Exception as validation_error:
+                logger.error(f"Validation error: {validation_error}")
+                # Return partial data on validation failure
+                result = ExtractResponse(
+                    allergens=normalized_data.get("allergens", []),
+                    nutrition=normalized_data.get("nutrition"),
+                    meta={"validation_error": str(validation_error)}
+                )
+            
+            # Add metadata
+            result.meta.update({
+                "mode": extraction_mode,
+                "text_length": len(extracted_text),
+                "model": GROQ_MODEL,
+                "filename": file.filename,
+                "file_size_mb": round(file_size_mb, 2)
+            })
+            
+            logger.info(f"✓ Successfully processed {file.filename}")
+            return result
         
-        # Add metadata
-        result.meta.update({
-            "mode": extraction_mode,
-            "text_length": len(extracted_text),
-            "model": GROQ_MODEL,
-            "filename": file.filename,
-            "file_size_mb": round(file_size_mb, 2)
-        })
-        
-        logger.info(f"✓ Successfully processed {file.filename}")
-        return result
-    
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.exception(f"Unexpected error processing {file.filename}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to process PDF: {str(e)}"
-        )
-    finally:
-        # Clean up temporary file
-        try:
-            os.remove(pdf_path)
-        except:
-            pass
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.exception(f"Unexpected error processing {file.filename}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to process PDF: {str(e)}"
+            )
 
 # --- Run Server ---
 if __name__ == "__main__":
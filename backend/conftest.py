@@ -0,0 +1,4 @@
+import os
+
+# Keep the test run from creating llm_cache.db in the working directory
+os.environ["LLM_CACHE_PATH"] = ""
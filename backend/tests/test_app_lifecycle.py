@@ -0,0 +1,43 @@
+from fastapi.testclient import TestClient
+
+import app.main as main
+
+
+def _text_pdf(text: str) -> bytes:
+    stream = f"BT /F1 10 Tf 20 150 Td ({text}) Tj ET".encode("latin-1")
+    return (
+        b"%PDF-1.4\n"
+        b"1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+        b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+        b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 600 200]/Contents 4 0 R"
+        b"/Resources<</Font<</F1 5 0 R>>>>>>endobj\n"
+        b"4 0 obj<</Length " + str(len(stream)).encode() + b">>stream\n" + stream + b"\nendstream endobj\n"
+        b"5 0 obj<</Type/Font/Subtype/Type1/BaseFont/Helvetica>>endobj\n"
+        b"trailer<</Root 1 0 R>>\n%%EOF"
+    )
+
+
+LABEL_PDF = _text_pdf(
+    "Ingredients: wheat flour, sugar, butter (milk), eggs. Energy 2000 kJ / 478 kcal, fat 19.5 g, protein 7.2 g"
+)
+
+
+def test_ocr_pool_survives_repeated_startup():
+    with TestClient(main.app):
+        pass
+    with TestClient(main.app):
+        pass
+
+    assert main._get_ocr_pool().submit(lambda: 42).result() == 42
+
+
+def test_extract_works_without_lifespan(monkeypatch):
+    monkeypatch.setattr(main, "extract_with_groq", lambda text, timeout_seconds=60: {"product_name": "Keksz"})
+
+    response = TestClient(main.app).post(
+        "/api/extract", files={"file": ("label.pdf", LABEL_PDF, "application/pdf")}
+    )
+
+    assert response.status_code == 200
+    assert response.json()["product_name"] == "Keksz"
+    assert response.json()["meta"]["mode"] == "text"
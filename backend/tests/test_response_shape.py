@@ -0,0 +1,45 @@
+import json
+from pathlib import Path
+
+import pytest
+
+import app.main as main
+
+# Hand-written in the JSON shape SYSTEM_PROMPT asks for, not recorded from Groq:
+# these tests pin normalize_data and the response schema, not model behaviour
+FIXTURES_DIR = Path(__file__).parent / "fixtures" / "sample_responses"
+FIXTURES = sorted(FIXTURES_DIR.glob("*.json"))
+
+ALLERGEN_NAMES = [
+    "Gluten", "Eggs", "Crustaceans", "Fish", "Peanuts",
+    "Soybeans", "Milk", "Nuts", "Celery", "Mustard",
+]
+
+
+def test_prompt_lists_allergens_in_order():
+    assert json.dumps(ALLERGEN_NAMES) in main.SYSTEM_PROMPT
+
+
+@pytest.mark.parametrize("fixture", FIXTURES, ids=lambda path: path.stem)
+def test_sample_response_keeps_shape(fixture):
+    raw = json.loads(fixture.read_text(encoding="utf-8"))
+
+    result = main.ExtractResponse.model_validate(main.normalize_data(raw))
+
+    assert [allergen.name for allergen in result.allergens] == ALLERGEN_NAMES
+    assert set(result.nutrition.model_dump()) == set(main.Nutrition.model_fields)
+    for field in main.NUTRITION_NUMERIC_FIELDS:
+        value = getattr(result.nutrition, field)
+        assert value is None or isinstance(value, float)
+    assert result.net_quantity is None or isinstance(result.net_quantity.amount, float)
+    assert result.meta["confidence"] in ("high", "medium", "low")
+
+
+def test_sample_strings_are_normalized():
+    raw = json.loads((FIXTURES_DIR / "butter_biscuit.json").read_text(encoding="utf-8"))
+
+    result = main.ExtractResponse.model_validate(main.normalize_data(raw))
+
+    assert result.nutrition.fat_g == 19.5
+    assert result.nutrition.energy_kj == 2000.0
+    assert (result.net_quantity.amount, result.net_quantity.unit) == (200.0, "g")
@@ -0,0 +1,77 @@
+import random
+
+import pytest
+
+import app.main as main
+
+
+def _label(seed: int = 0, words: int = 150) -> str:
+    rng = random.Random(seed)
+    vocab = ["".join(rng.choice("abcdefghijklmnoprstuvzáéíóöőúü") for _ in range(rng.randint(3, 10)))
+             for _ in range(400)]
+    text = " ".join(rng.choice(vocab) for _ in range(words))
+    return text + "\nEnergia 1500 kJ / 360 kcal, zsír 4,5 g, fehérje 8 g"
+
+
+def _typos(text: str, count: int, seed: int = 1) -> str:
+    rng = random.Random(seed)
+    words = text.split(" ")
+    for index in rng.sample(range(100), count):
+        words[index] = words[index][:-1] + "x"
+    return " ".join(words)
+
+
+def _similarity(a: str, b: str) -> float:
+    return main._sketch_similarity(main._text_fingerprint(a)[1], main._text_fingerprint(b)[1])
+
+
+def test_ocr_noise_stays_above_threshold():
+    label = _label()
+    assert _similarity(label, _typos(label, 3)) >= main.SEMANTIC_CACHE_THRESHOLD
+
+
+def test_heavy_rewording_and_other_labels_miss():
+    label = _label()
+    assert _similarity(label, _typos(label, 30)) < main.SEMANTIC_CACHE_THRESHOLD
+    assert _similarity(label, _label(seed=2)) < main.SEMANTIC_CACHE_THRESHOLD
+
+
+def test_different_numbers_never_share_a_fingerprint():
+    label = _label()
+    assert main._text_fingerprint(label)[0] != main._text_fingerprint(label.replace("4,5 g", "5,5 g"))[0]
+    assert main._text_fingerprint(label)[0] == main._text_fingerprint(_typos(label, 3))[0]
+
+
+def test_allergen_wording_never_shares_a_fingerprint():
+    label = _label()
+    key = main._text_fingerprint(label)[0]
+    assert main._text_fingerprint(label + "\nNyomokban tartalmazhat: mogyoró, szója.")[0] != key
+    assert main._text_fingerprint(label + "\nTejmentes.")[0] != key
+    assert main._text_fingerprint(label + "\nTej: +")[0] != main._text_fingerprint(label + "\nTej: -")[0]
+
+
+@pytest.fixture
+def llm_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "LLM_CACHE_PATH", str(tmp_path / "llm_cache.db"))
+    monkeypatch.setattr(main._llm_cache_local, "conn", None, raising=False)
+    main._llm_cache_init()
+    yield
+    main._llm_cache_local.conn.close()
+
+
+def test_noisy_rescan_hits_the_cache(llm_cache):
+    label = _label()
+    main._semantic_cache_put(*main._text_fingerprint(label), {"product_name": "Keksz"})
+
+    assert main._semantic_cache_get(*main._text_fingerprint(_typos(label, 3))) == {"product_name": "Keksz"}
+    assert main._semantic_cache_get(*main._text_fingerprint(_typos(label, 30))) is None
+
+
+def test_may_contain_line_misses_the_cache(llm_cache):
+    label = _label()
+    may_contain = label + "\nNyomokban tartalmazhat: mogyoró, szója."
+    main._semantic_cache_put(*main._text_fingerprint(label), {"product_name": "Keksz"})
+
+    assert main._semantic_cache_get(*main._text_fingerprint(may_contain)) is None
+    main._semantic_cache_put(*main._text_fingerprint(may_contain), {"product_name": "Mogyorós keksz"})
+    assert main._semantic_cache_get(*main._text_fingerprint(_typos(label, 3))) == {"product_name": "Keksz"}
@@ -0,0 +1,49 @@
+import app.main as main
+
+
+def _filler(words: int, word: str = "lorem") -> str:
+    return " ".join(f"{word}{i % 97}" for i in range(words))
+
+
+def _content_length(text: str) -> int:
+    return len(text.replace(main.TRUNCATION_MARKER, ""))
+
+
+def test_short_text_is_untouched():
+    text = "Összetevők: búzaliszt. Energia 1500 kJ"
+    assert main._truncate_for_llm(text, max_chars=1000) == text
+
+
+def test_dense_headings_keep_table_at_the_end():
+    early = " ".join(f"energy saving tip {i}: " + _filler(20) for i in range(240))
+    text = "Keksz Kft. Vajas keksz\n" + early + "\n" + _filler(1000, "x") + "\nTápérték 100 g: energia 1500 kJ"
+    assert len(text) > 40000
+
+    result = main._truncate_for_llm(text)
+
+    assert "energia 1500 kJ" in result
+    assert result.startswith("Keksz Kft. Vajas keksz")
+    assert _content_length(result) <= main.LLM_MAX_CHARS
+
+
+def test_sparse_headings_use_the_whole_budget():
+    text = (
+        "Vajas keksz\n" + _filler(2500) + "\nÖsszetevők: búzaliszt, vaj\n"
+        + _filler(2000) + "\nEnergia 2000 kJ\n" + _filler(1000)
+    )
+    assert len(text) > 30000
+
+    result = main._truncate_for_llm(text)
+
+    assert "Összetevők: búzaliszt, vaj" in result
+    assert "Energia 2000 kJ" in result
+    assert main.LLM_MAX_CHARS - 500 <= _content_length(result) <= main.LLM_MAX_CHARS
+
+
+def test_no_headings_falls_back_to_head_and_tail():
+    text = "HEAD " + _filler(5000) + " TAIL"
+
+    result = main._truncate_for_llm(text)
+
+    assert result.startswith("HEAD") and result.endswith("TAIL")
+    assert _content_length(result) <= main.LLM_MAX_CHARS